@@ -41,7 +41,11 @@ class EOTransformer():
                 '''
         if self.spatial_encoder == False:  
             if self.random_extraction == 0: # average over field mask: T, D = image_stack.shape
-                image_stack = image_stack[:, :, mask > 0].mean(2)
+                # mean over the field as one matrix-vector product with normalized mask weights,
+                # avoids the copy of all field pixels made by boolean indexing
+                weights = (mask > 0).ravel()
+                weights = (weights / weights.sum()).astype(np.result_type(image_stack.dtype, np.float32))
+                image_stack = image_stack.reshape(image_stack.shape[0], image_stack.shape[1], -1) @ weights
                 mask = np.array(-1)  # mask is meaningless now but needs to be constant size for batching
             else:
                 # according to https://github.com/VSainteuf/lightweight-temporal-attention-pytorch/blob/master/dataset.py
@@ -81,9 +85,8 @@ class EOTransformer():
             image_stack, mask = crop_or_pad_to_size(image_stack, mask, self.image_size)
 
             # rotations
-            rot = np.random.choice([0, 1, 2, 3])
-            image_stack = np.rot90(image_stack, rot, [2, 3]) # rotate in plane defined by [2,3]
-            mask = np.rot90(mask, rot)
+            rot = np.random.randint(4) # same draws as np.random.choice([0, 1, 2, 3]) without building an array each call
+            image_stack, mask = rotate(image_stack, mask, rot) # rotate in plane defined by [2,3]
 
             # flip up down
             #if np.random.rand() < 0.5:
@@ -95,14 +98,20 @@ class EOTransformer():
             #    image_stack = np.fliplr(image_stack)
             #    mask = np.fliplr(mask)
 
-        image_stack = image_stack * 1e-4
-
-        # z-normalize
+        # scale and z-normalize, computed in float32 (the dtype stored by the preprocessor) also for integer raw data
         if self.normalize:
-            image_stack -= 0.1014 + np.random.normal(scale=0.01)
-            image_stack /= 0.1171 + np.random.normal(scale=0.01)
-
-        return image_stack, mask
+            # both jitters in one RNG call, same draws as two scalar calls
+            mean_jitter, std_jitter = np.random.normal(scale=0.01, size=2)
+            mean = 0.1014 + mean_jitter
+            std = 0.1171 + std_jitter
+            # (x * 1e-4 - mean) / std folded into one multiply and one in-place subtract
+            image_stack = np.multiply(image_stack, 1e-4 / std, order='C', dtype=np.float32)
+            image_stack -= mean / std
+        else:
+            image_stack = np.multiply(image_stack, 1e-4, order='C', dtype=np.float32)
+
+        # contiguous float32 is guaranteed on exit, this does not copy as the scaling step already produced it
+        return np.ascontiguousarray(image_stack, dtype=np.float32), mask
 
 class PlanetTransform(EOTransformer):
     """
@@ -142,13 +151,33 @@ def random_crop(image_stack, mask, image_size):
     h = np.random.randint(image_size, H - image_size // 2)
     w = np.random.randint(image_size, W - image_size // 2)
 
-    image_stack = image_stack[:, :, h - int(np.floor(image_size // 2)):int(np.ceil(h + image_size // 2)),
-                  w - int(np.floor(image_size // 2)):int(np.ceil(w + image_size // 2))]
-    mask = mask[h - int(np.floor(image_size // 2)):int(np.ceil(h + image_size // 2)),
-           w - int(np.floor(image_size // 2)):int(np.ceil(w + image_size // 2))]
+    # all bounds are integers already, no flooring or ceiling needed
+    half = image_size // 2
+    image_stack = image_stack[:, :, h - half:h + half, w - half:w + half]
+    mask = mask[h - half:h + half, w - half:w + half]
 
     return image_stack, mask
 
+def rotate(image_stack, mask, rot):
+    '''
+    THIS FUNCTION ROTATES THE IMAGE BY rot * 90 DEGREES, SAME AS np.rot90 IN THE PLANE OF HEIGHT AND WIDTH.
+    A view of the image is returned, the copy to contiguous memory happens once in the scaling step of the transform.
+    The small mask is copied to contiguous memory here.
+     :param image_stack: input image in size [Time Stamp, Image Dimension (Channel), Height, Width]
+    :param mask: input mask of the image, to filter out uninterested areas [Height, Width]
+    :param rot: number of 90 degree rotations in {0, 1, 2, 3}
+    :return: image_stack, mask
+    '''
+    if rot == 0:
+        return image_stack, mask
+    if rot == 1:
+        image_stack, mask = image_stack.transpose(0, 1, 3, 2)[:, :, ::-1, :], mask.T[::-1, :]
+    elif rot == 2:
+        image_stack, mask = image_stack[:, :, ::-1, ::-1], mask[::-1, ::-1]
+    else:
+        image_stack, mask = image_stack.transpose(0, 1, 3, 2)[:, :, :, ::-1], mask.T[:, ::-1]
+    return image_stack, np.ascontiguousarray(mask)
+
 def crop_or_pad_to_size(image_stack,  mask, image_size):
     '''
     THIS FUNCTION DETERMINES IF IMAGE TO BE CROPPED OR PADDED TO THE GIVEN SIZE.
@@ -159,29 +188,33 @@ def crop_or_pad_to_size(image_stack,  mask, image_size):
     :return: image_stack, mask
     '''
     T, D, H, W = image_stack.shape
-    hpad = image_size - H
-    wpad = image_size - W
-
-    # local flooring and ceiling helper functions to save some space
-    def f(x):
-        return int(np.floor(x))
-    def c(x):
-        return int(np.ceil(x))
-
-    # crop image if image_size < H,W
-    if hpad < 0:
-        image_stack = image_stack[:, :, -c(hpad) // 2:f(hpad) // 2, :]
-        mask = mask[-c(hpad) // 2:f(hpad) // 2, :]
-    if wpad < 0:
-        image_stack = image_stack[:, :, :, -c(wpad) // 2:f(wpad) // 2]
-        mask = mask[:, -c(wpad) // 2:f(wpad) // 2]
-    # pad image if image_size > H, W
-    if hpad > 0:
-        padding = (f(hpad / 2), c(hpad / 2))
-        image_stack = np.pad(image_stack, ((0, 0), (0, 0), padding, (0, 0)))
-        mask = np.pad(mask, (padding, (0, 0)))
-    if wpad > 0:
-        padding = (f(wpad / 2), c(wpad / 2))
-        image_stack = np.pad(image_stack, ((0, 0), (0, 0), (0, 0), padding))
-        mask = np.pad(mask, ((0, 0), padding))
-    return image_stack, mask
+    if H == image_size and W == image_size:
+        return image_stack, mask
+
+    # crop image if image_size < H,W and pad image if image_size > H,W
+    hcrop, hpad = _crop_or_pad_bounds(H, image_size)
+    wcrop, wpad = _crop_or_pad_bounds(W, image_size)
+
+    hdst = slice(hpad, hpad + hcrop.stop - hcrop.start)
+    wdst = slice(wpad, wpad + wcrop.stop - wcrop.start)
+
+    # one allocation and one copy into the interior, the zero border is the padding
+    out_stack = np.zeros((T, D, image_size, image_size), dtype=image_stack.dtype)
+    out_stack[:, :, hdst, wdst] = image_stack[:, :, hcrop, wcrop]
+    out_mask = np.zeros((image_size, image_size), dtype=mask.dtype)
+    out_mask[hdst, wdst] = mask[hcrop, wcrop]
+
+    return out_stack, out_mask
+
+def _crop_or_pad_bounds(size, image_size):
+    '''
+    THIS FUNCTION COMPUTES THE CROP SLICE AND THE LEADING PAD WIDTH FOR ONE AXIS.
+    :param size: size of the input image along the axis
+    :param image_size: target size along the axis
+    :return: slice of the input to keep, number of zeros to pad in front
+    '''
+    diff = image_size - size
+    if diff < 0:
+        start = -diff // 2
+        return slice(start, start + image_size), 0
+    return slice(0, size), diff // 2
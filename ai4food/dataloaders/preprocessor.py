@@ -380,7 +380,7 @@ class Preprocessor(object):
                 start_time = time.time()
             for key in keys:
                 if key == 'image_stack':
-                   raw_ds[key].extend(sample[0].astype(np.float32))
+                   raw_ds[key].extend(sample[0].astype(np.float32, copy=False)) # transform output is float32 already
                 elif key == 'label':
                    raw_ds[key].append(sample[1])
                 elif key == 'mask':
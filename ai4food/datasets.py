@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 
+import torch
 from torch.utils.data import Dataset
 import h5py
 import os
 import numpy as np
 import geopandas as gpd
-from torch import randn
+from torch import randn, as_tensor
 import time
 from scipy.interpolate import splrep, splev
 from scipy.signal import savgol_filter
@@ -88,8 +89,10 @@ class EarthObservationDataset(Dataset):
         if self.extra_features is not None:
             extra_f = self.extra_features[idx]
         else: extra_f = np.zeros_like(1)
-            
-        return (X, mask, fid, extra_f), label
+
+        # zero-copy tensor views on the loaded arrays, so the DataLoader
+        # stacks them straight into the (shared memory) batch tensor
+        return (as_tensor(X), as_tensor(mask), as_tensor(fid), as_tensor(extra_f)), as_tensor(label)
 
 class Sentinel2Dataset(EarthObservationDataset):
     '''
@@ -412,8 +415,23 @@ class CombinedDataset(Dataset):
             print('Assert dataset shape match', i-1, i)
             assert (self.datasets[i-1].fid==self.datasets[i].fid).all(),'s1, s2 and/or planet not sorted correctly'
     
+    @property
+    def labels(self):
+        '''
+        Labels of all samples, without loading any image data
+        (the same for all datasets, see the fid assertion above)
+        '''
+        return self.datasets[0].labels
+
+    @property
+    def field_ids(self):
+        '''
+        Field id of all samples, without loading any image data
+        '''
+        return self.datasets[0].fid
+
     def __len__(self):
-        return len(self.datasets[0].labels) 
+        return len(self.labels) 
     
     def __getitem__(self, idx):
         return tuple(d[idx] for d in self.datasets)
@@ -428,7 +446,53 @@ class AddGaussianNoise(object):
         self.mean = mean
         
     def __call__(self, tensor):
-        return tensor + randn(tensor.size()) * self.std + self.mean
+        return tensor + randn(tensor.size(), device=tensor.device) * self.std + self.mean
     
     def __repr__(self):
         return self.__class__.__name__ + '(mean={0}, std={1})'.format(self.mean, self.std)
+
+
+class CUDAPrefetcher(object):
+    '''
+    Wrap a DataLoader such that the copy of the next batch to the GPU
+    runs on a separate CUDA stream while the current batch is processed
+
+    Yields the batches of the loader with all tensors on device
+    '''
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.memcpy_stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        iterator = iter(self.loader)
+        next_batch = self._preload(iterator)
+        while next_batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(self.memcpy_stream)
+            batch = next_batch
+            # the batch was allocated on the copy stream, keep its memory until the compute stream is done with it
+            CUDAPrefetcher._apply(batch, lambda t: t.record_stream(torch.cuda.current_stream(self.device)))
+            next_batch = self._preload(iterator)
+            yield batch
+
+    def _preload(self, iterator):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.memcpy_stream):
+            return CUDAPrefetcher._apply(batch, lambda t: t.to(self.device, non_blocking=True))
+
+    @staticmethod
+    def _apply(batch, fn):
+        '''
+        Apply fn to all tensors in the nested tuples / lists of a batch
+        '''
+        if isinstance(batch, torch.Tensor):
+            return fn(batch)
+        if isinstance(batch, (tuple, list)):
+            return type(batch)(CUDAPrefetcher._apply(b, fn) for b in batch)
+        return batch
@@ -3,10 +3,7 @@ import numpy as np
 import pandas as pd
 import sklearn.metrics
 import torch
-import torch.nn as nn
 from tqdm import tqdm
-import torch.multiprocessing
-torch.multiprocessing.set_sharing_strategy('file_system')
 
 from torch import autograd
 
@@ -19,19 +16,33 @@ def metrics(y_true, y_pred):
 
     :return: dictionary of Accuracy, Kappa, F1, Recall, and Precision
     """
-    accuracy = sklearn.metrics.accuracy_score(y_true, y_pred)
-    kappa = sklearn.metrics.cohen_kappa_score(y_true, y_pred)
-    f1_micro = sklearn.metrics.f1_score(y_true, y_pred, average="micro", zero_division=0)
-    f1_macro = sklearn.metrics.f1_score(y_true, y_pred, average="macro", zero_division=0)
-    f1_weighted = sklearn.metrics.f1_score(y_true, y_pred, average="weighted", zero_division=0)
-    recall_micro = sklearn.metrics.recall_score(y_true, y_pred, average="micro")
-    recall_macro = sklearn.metrics.recall_score(y_true, y_pred, average="macro")
-    recall_weighted = sklearn.metrics.recall_score(y_true, y_pred, average="weighted")
-    precision_micro = sklearn.metrics.precision_score(y_true, y_pred, average="micro", zero_division=0)
-    precision_macro = sklearn.metrics.precision_score(y_true, y_pred, average="macro", zero_division=0)
-    precision_weighted = sklearn.metrics.precision_score(y_true, y_pred, average="weighted")
-    cm = sklearn.metrics.confusion_matrix(y_true, y_pred)
-    cm = cm.astype('float') / cm.sum(axis=1)[:, np.newaxis] # normalise confusion matrix to get accurac for each class
+    # build the confusion matrix once and derive all scores from it
+    y_true = np.asarray(y_true)
+    y_pred = np.asarray(y_pred)
+    labels = np.union1d(y_true, y_pred)
+    cm = sklearn.metrics.confusion_matrix(y_true, y_pred, labels=labels)
+
+    tp = np.diag(cm).astype('float')
+    fp = cm.sum(axis=0) - tp
+    fn = cm.sum(axis=1) - tp
+    support = cm.sum(axis=1)
+    n_samples = cm.sum()
+
+    precision = _safe_divide(tp, tp + fp)
+    recall = _safe_divide(tp, tp + fn)
+    f1 = _safe_divide(2 * tp, 2 * tp + fp + fn)
+
+    # micro averages coincide with the accuracy for single-label multiclass data
+    accuracy = tp.sum() / n_samples
+    f1_micro = recall_micro = precision_micro = accuracy
+    f1_macro, recall_macro, precision_macro = f1.mean(), recall.mean(), precision.mean()
+    f1_weighted, recall_weighted, precision_weighted = [np.average(score, weights=support) for score in (f1, recall, precision)]
+
+    expected = np.outer(cm.sum(axis=1), cm.sum(axis=0)) / n_samples
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        kappa = 1 - (n_samples - tp.sum()) / (expected.sum() - np.trace(expected))
+        accuracy_per_class = tp / support # normalised confusion matrix diagonal gives the accuracy for each class
 
     return dict(
         accuracy=accuracy,
@@ -45,9 +56,16 @@ def metrics(y_true, y_pred):
         precision_micro=precision_micro,
         precision_macro=precision_macro,
         precision_weighted=precision_weighted,
-        accuracy_per_class=cm.diagonal()
+        accuracy_per_class=accuracy_per_class
     )
 
+def _safe_divide(numerator, denominator):
+    '''
+    element-wise division that returns 0 where the denominator is 0,
+    same as zero_division=0 in sklearn.metrics
+    '''
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator, dtype='float'), where=denominator != 0)
+
 
 def bin_cross_entr_each_crop(logprobs, y_true, classes, device, args):
     '''
@@ -59,25 +77,18 @@ def bin_cross_entr_each_crop(logprobs, y_true, classes, device, args):
     
     :return: sum of binary cross entropy for each class 
     '''
-    bin_ce = 0
-    sm = nn.Softmax(dim=1)
-    y_prob = sm(logprobs)
-    # convert to one-hot representation
-    y_prob_ids = torch.argmax(y_prob, dim=1)
-    y_pred_onehot = nn.functional.one_hot(y_prob_ids, num_classes=args.nr_classes).float()
-    y_true_onehot = nn.functional.one_hot(y_true, num_classes=args.nr_classes).float()
-    #y_prob_clipped = torch.clip(y_pred_onehot, 1e-7, 1-1e-7)
+    y_prob = torch.softmax(logprobs, dim=1)
     y_prob_clipped = torch.clip(y_prob, 1e-7, 1-1e-7)
-    bin_ce = torch.tensor(bin_ce)
-    #loss_batch = -torch.log(y_prob_clipped[range(len(y_pred_onehot)), y_true])
-    loss_batch = -torch.log(y_prob_clipped[range(len(y_prob)), y_true])
+    # the true class is picked by index, no one-hot representation is needed;
+    # a single gather replaces indexing with a python range
+    loss_batch = -torch.log(y_prob_clipped.gather(1, y_true.view(-1, 1)))
     bin_ce = torch.sum(loss_batch)
 
     return bin_ce
 
 
 
-def train_epoch(model, optimizer, dataloader, classes, criterion, args, device='cpu', gaussian_noise_aug=None):
+def train_epoch(model, optimizer, dataloader, classes, criterion, args, device='cpu', gaussian_noise_aug=None, scaler=None):
     """
     THIS FUNCTION ITERATES A SINGLE EPOCH FOR TRAINING
 
@@ -86,58 +97,67 @@ def train_epoch(model, optimizer, dataloader, classes, criterion, args, device='
     :param criterion: torch objective for loss calculation
     :param dataloader: training data loader
     :param device: where to run the epoch
+    :param scaler: torch.cuda.amp.GradScaler for mixed precision training (args.amp)
 
-    :return: loss
+    :return: loss of each step, kept on device
     """
+    if scaler is None:
+        scaler = torch.cuda.amp.GradScaler(enabled=False)
     model.train()
-    losses = list()
+    # per-step losses are written into a preallocated tensor, detached so the graph of each step is freed
+    losses = torch.empty(len(dataloader), device=device)
     with tqdm(enumerate(dataloader), total=len(dataloader),position=0, leave=True, disable=True) as iterator:
         for idx, batch in iterator:
             optimizer.zero_grad()
            
-            # for only one input
-            if len(args.input_data)==1:
-                # either pseltae or spatiotemporal model
-                (x, mask, _, extra_features), y_true = batch[0]
-                if args.augmentation: 
-                    x = gaussian_noise_aug(x)
-                if args.include_extras: logprobs = model(((x.to(device), mask.to(device)), extra_features.to(device)))
-                else: logprobs = model((x.to(device), mask.to(device)))
+            # forward pass in mixed precision if args.amp, the loss is computed in float32 below
+            with torch.cuda.amp.autocast(enabled=bool(args.amp)):
+                # for only one input
+                if len(args.input_data)==1:
+                    # either pseltae or spatiotemporal model
+                    (x, mask, _, extra_features), y_true = batch[0]
+                    if args.augmentation: 
+                        x = gaussian_noise_aug(x)
+                    if args.include_extras: logprobs = model(((x.to(device, non_blocking=True), mask.to(device, non_blocking=True)), extra_features.to(device, non_blocking=True)))
+                    else: logprobs = model((x.to(device, non_blocking=True), mask.to(device, non_blocking=True)))
                         
-            # for two data inputs - planet and sentinel-1
-            elif len(args.input_data)==2:
-                sample_planet, sample_s1 = batch
+                # for two data inputs - planet and sentinel-1
+                elif len(args.input_data)==2:
+                    sample_planet, sample_s1 = batch
                 
-                (x_p, mask_p, _, extra_features), y_true = sample_planet
-                (x_s1, mask_s1, _, extra_features), _ = sample_s1
+                    (x_p, mask_p, _, extra_features), y_true = sample_planet
+                    (x_s1, mask_s1, _, extra_features), _ = sample_s1
                 
-                if args.augmentation: 
-                    x_p = gaussian_noise_aug(x_p)
-                    x_s1 = gaussian_noise_aug(x_s1)
+                    if args.augmentation: 
+                        x_p = gaussian_noise_aug(x_p)
+                        x_s1 = gaussian_noise_aug(x_s1)
                 
-                if args.include_extras: logprobs = model((((x_p.to(device), mask_p.to(device)), extra_features.to(device)), (x_s1.to(device), mask_s1.to(device))))
-                else: logprobs = model(((x_p.to(device), mask_p.to(device)), (x_s1.to(device), mask_s1.to(device))))
+                    if args.include_extras: logprobs = model((((x_p.to(device, non_blocking=True), mask_p.to(device, non_blocking=True)), extra_features.to(device, non_blocking=True)), (x_s1.to(device, non_blocking=True), mask_s1.to(device, non_blocking=True))))
+                    else: logprobs = model(((x_p.to(device, non_blocking=True), mask_p.to(device, non_blocking=True)), (x_s1.to(device, non_blocking=True), mask_s1.to(device, non_blocking=True))))
                 
-            # or for three inputs - planet, sentinel-1 and sentinel-2   
-            elif len(args.input_data)==3:
-                sample_planet, sample_s1, sample_s2 = batch                
-                (x_p, mask_p, _, extra_features), y_true = sample_planet
-                (x_s1, mask_s1, _, _), _ = sample_s1
-                (x_s2, mask_s2, _, _), _ = sample_s2
+                # or for three inputs - planet, sentinel-1 and sentinel-2   
+                elif len(args.input_data)==3:
+                    sample_planet, sample_s1, sample_s2 = batch                
+                    (x_p, mask_p, _, extra_features), y_true = sample_planet
+                    (x_s1, mask_s1, _, _), _ = sample_s1
+                    (x_s2, mask_s2, _, _), _ = sample_s2
                 
-                if args.augmentation: 
-                    x_p = gaussian_noise_aug(x_p)
-                    x_s1 = gaussian_noise_aug(x_s1)
-                    x_s2 = gaussian_noise_aug(x_s2)
+                    if args.augmentation: 
+                        x_p = gaussian_noise_aug(x_p)
+                        x_s1 = gaussian_noise_aug(x_s1)
+                        x_s2 = gaussian_noise_aug(x_s2)
                     
-                if args.include_extras: logprobs = model((((x_p.to(device), mask_p.to(device)), extra_features.to(device)), (x_s1.to(device), mask_s1.to(device)), (x_s2.to(device), mask_s2.to(device))))
-                else: logprobs = model(((x_p.to(device), mask_p.to(device)), (x_s1.to(device), mask_s1.to(device)), (x_s2.to(device), mask_s2.to(device))))
+                    if args.include_extras: logprobs = model((((x_p.to(device, non_blocking=True), mask_p.to(device, non_blocking=True)), extra_features.to(device, non_blocking=True)), (x_s1.to(device, non_blocking=True), mask_s1.to(device, non_blocking=True)), (x_s2.to(device, non_blocking=True), mask_s2.to(device, non_blocking=True))))
+                    else: logprobs = model(((x_p.to(device, non_blocking=True), mask_p.to(device, non_blocking=True)), (x_s1.to(device, non_blocking=True), mask_s1.to(device, non_blocking=True)), (x_s2.to(device, non_blocking=True), mask_s2.to(device, non_blocking=True))))
             
-            y_true = y_true.to(device)
-            loss = criterion(logprobs, y_true)
-            loss.backward()
+            y_true = y_true.to(device, non_blocking=True)
+            loss = criterion(logprobs.float(), y_true)
+            # the scaler is a no-op unless mixed precision is enabled
+            scaler.scale(loss).backward()
+            scaler.unscale_(optimizer)
             torch.nn.utils.clip_grad_norm_(model.parameters(), 2)
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
              
             '''
             For DEBUGGING only
@@ -153,9 +173,11 @@ def train_epoch(model, optimizer, dataloader, classes, criterion, args, device='
                 torch.nn.utils.clip_grad_norm_(model.parameters(), 1)
                 optimizer.step()
             '''
-            iterator.set_description(f"train loss={loss:.2f}")
-            losses.append(loss)
-    return torch.stack(losses)
+            # formatting the loss syncs with the GPU, so only do it every few steps and if the progress bar is shown
+            if not iterator.disable and idx % 10 == 0:
+                iterator.set_description(f"train loss={loss.item():.2f}")
+            losses[idx] = loss.detach()
+    return losses
 
 
 def validation_epoch(model, dataloader, classes, criterion, args, device='cpu'):
@@ -171,7 +193,7 @@ def validation_epoch(model, dataloader, classes, criterion, args, device='cpu'):
     """
     model.eval()
     with torch.no_grad():
-        losses = list()
+        losses = torch.empty(len(dataloader), device=device)
         y_true_list = list()
         y_pred_list = list()
         y_score_list = list()
@@ -182,30 +204,33 @@ def validation_epoch(model, dataloader, classes, criterion, args, device='cpu'):
             for idx, batch in iterator:              
 
                            
-                # for only one input
-                if len(args.input_data)==1:
-                    (x, mask, field_id, extra_features), y_true = batch[0]
-                    if args.include_extras: logprobs = model(((x.to(device), mask.to(device)), extra_features.to(device)))
-                    else: logprobs = model((x.to(device), mask.to(device)))
-
-                # for two data inputs - planet and sentinel-1
-                elif len(args.input_data)==2:
-                    sample_planet, sample_s1 = batch
-                    (x_p, mask_p, field_id, extra_features), y_true = sample_planet
-                    (x_s1, mask_s1, _, extra_features), _ = sample_s1
-                    if args.include_extras: logprobs = model((((x_p.to(device), mask_p.to(device)), extra_features.to(device)), (x_s1.to(device), mask_s1.to(device))))
-                    else: logprobs = model(((x_p.to(device), mask_p.to(device)), (x_s1.to(device), mask_s1.to(device))))
-
-                # or for three inputs - planet, sentinel-1 and sentinel-2   
-                elif len(args.input_data)==3:
-                    sample_planet, sample_s1, sample_s2 = batch                
-                    (x_p, mask_p, field_id, extra_features), y_true = sample_planet
-                    (x_s1, mask_s1, _, _), _ = sample_s1
-                    (x_s2, mask_s2, _, _), _ = sample_s2
-                    if args.include_extras: logprobs = model((((x_p.to(device), mask_p.to(device)), extra_features.to(device)), (x_s1.to(device), mask_s1.to(device)), (x_s2.to(device), mask_s2.to(device))))
-                    else: logprobs = model(((x_p.to(device), mask_p.to(device)), (x_s1.to(device), mask_s1.to(device)), (x_s2.to(device), mask_s2.to(device))))
+                # forward pass in mixed precision if args.amp
+                with torch.cuda.amp.autocast(enabled=bool(args.amp)):
+                    # for only one input
+                    if len(args.input_data)==1:
+                        (x, mask, field_id, extra_features), y_true = batch[0]
+                        if args.include_extras: logprobs = model(((x.to(device, non_blocking=True), mask.to(device, non_blocking=True)), extra_features.to(device, non_blocking=True)))
+                        else: logprobs = model((x.to(device, non_blocking=True), mask.to(device, non_blocking=True)))
+
+                    # for two data inputs - planet and sentinel-1
+                    elif len(args.input_data)==2:
+                        sample_planet, sample_s1 = batch
+                        (x_p, mask_p, field_id, extra_features), y_true = sample_planet
+                        (x_s1, mask_s1, _, extra_features), _ = sample_s1
+                        if args.include_extras: logprobs = model((((x_p.to(device, non_blocking=True), mask_p.to(device, non_blocking=True)), extra_features.to(device, non_blocking=True)), (x_s1.to(device, non_blocking=True), mask_s1.to(device, non_blocking=True))))
+                        else: logprobs = model(((x_p.to(device, non_blocking=True), mask_p.to(device, non_blocking=True)), (x_s1.to(device, non_blocking=True), mask_s1.to(device, non_blocking=True))))
+
+                    # or for three inputs - planet, sentinel-1 and sentinel-2   
+                    elif len(args.input_data)==3:
+                        sample_planet, sample_s1, sample_s2 = batch                
+                        (x_p, mask_p, field_id, extra_features), y_true = sample_planet
+                        (x_s1, mask_s1, _, _), _ = sample_s1
+                        (x_s2, mask_s2, _, _), _ = sample_s2
+                        if args.include_extras: logprobs = model((((x_p.to(device, non_blocking=True), mask_p.to(device, non_blocking=True)), extra_features.to(device, non_blocking=True)), (x_s1.to(device, non_blocking=True), mask_s1.to(device, non_blocking=True)), (x_s2.to(device, non_blocking=True), mask_s2.to(device, non_blocking=True))))
+                        else: logprobs = model(((x_p.to(device, non_blocking=True), mask_p.to(device, non_blocking=True)), (x_s1.to(device, non_blocking=True), mask_s1.to(device, non_blocking=True)), (x_s2.to(device, non_blocking=True), mask_s2.to(device, non_blocking=True))))
                 
-                y_true = y_true.to(device)
+                logprobs = logprobs.float()
+                y_true = y_true.to(device, non_blocking=True)
                 '''
                 For DEBUGGING only
                 if np.any(np.isnan(logprobs.detach().cpu().numpy())):
@@ -214,15 +239,18 @@ def validation_epoch(model, dataloader, classes, criterion, args, device='cpu'):
                         print(ii, ll, xx.shape, np.mean(xx), np.max(xx), np.min(xx), np.nanmax(xx), np.nanmin(xx))
                     assert False
                 '''
-                loss = criterion(logprobs, y_true.to(device))
-                iterator.set_description(f"valid loss={loss:.2f}")
-                losses.append(loss)
+                loss = criterion(logprobs, y_true)
+                if not iterator.disable and idx % 10 == 0:
+                    iterator.set_description(f"valid loss={loss.item():.2f}")
+                losses[idx] = loss
                 y_true_list.append(y_true)
-                y_pred_list.append(logprobs.argmax(-1))
-                y_score_list.append(logprobs.exp())
+                # one softmax pass gives the scores, the prediction is its argmax
+                y_score = logprobs.softmax(-1)
+                y_pred_list.append(y_score.argmax(-1))
+                y_score_list.append(y_score)
                 field_ids_list.append(field_id)
                 
-        return torch.stack(losses), torch.cat(y_true_list), torch.cat(y_pred_list), torch.cat(y_score_list), torch.cat(field_ids_list)
+        return losses, torch.cat(y_true_list), torch.cat(y_pred_list), torch.cat(y_score_list), torch.cat(field_ids_list)
 
 
 def save_reference(data_loader, device, label_ids, label_names, args):
@@ -276,8 +304,9 @@ def save_predictions(target_dir, model, data_loader, device, label_ids, label_na
             model.eval()
             print(f"INFO: Resuming from {save_model_path}, epoch {START_EPOCH}")
 
-            # list of dictionaries with predictions:
-            output_list=[]
+            # field ids in the order of the data loader
+            fid_list=[]
+            offset=0
             
             # if we are using extracted-640 data then we can average over 10 samples for each crop or just use one sample
             if args.avg_samples:
@@ -285,7 +314,8 @@ def save_predictions(target_dir, model, data_loader, device, label_ids, label_na
             else:
                 num_samples_per_crop = 1
 
-            with torch.no_grad():
+            # forward pass in mixed precision if args.amp, as in training
+            with torch.no_grad(), torch.cuda.amp.autocast(enabled=bool(args.amp)):
                 with tqdm(enumerate(data_loader), total=len(data_loader), position=0, leave=True, disable=True) as iterator:
                     for idx, batch in iterator:
                         for ext_id in range(num_samples_per_crop):
@@ -293,19 +323,19 @@ def save_predictions(target_dir, model, data_loader, device, label_ids, label_na
                                 (x_p, mask, fid, extra_features), _ = batch[0]
 
                                 if args.include_extras: 
-                                    logits = model(((x_p.to(device)[:,:,:,64*ext_id:64*(ext_id+1)], mask.to(device)[:,64*ext_id:64*(ext_id+1)]), extra_features.to(device)))  
+                                    logits = model(((x_p.to(device, non_blocking=True)[:,:,:,64*ext_id:64*(ext_id+1)], mask.to(device, non_blocking=True)[:,64*ext_id:64*(ext_id+1)]), extra_features.to(device, non_blocking=True)))  
                                 else: 
-                                    logits = model((x_p.to(device)[:,:,:,64*ext_id:64*(ext_id+1)], mask.to(device)[:,64*ext_id:64*(ext_id+1)]))
+                                    logits = model((x_p.to(device, non_blocking=True)[:,:,:,64*ext_id:64*(ext_id+1)], mask.to(device, non_blocking=True)[:,64*ext_id:64*(ext_id+1)]))
                             # for combined model - current implementation wo extra features
                             elif len(args.input_data)==2:
                                 sample_planet, sample_s1 = batch
                                 (x_p, mask_p, fid, extra_features), _ = sample_planet
                                 (x_s1, mask_s1, _, _), _ = sample_s1
                                 if args.include_extras:
-                                    logits = model((((x_p.to(device)[:,:,:,64*ext_id:64*(ext_id+1)], mask_p.to(device)[:,64*ext_id:64*(ext_id+1)]), extra_features.to(device)),
-                                                    ((x_s1.to(device)[:,:,:,64*ext_id:64*(ext_id+1)], mask_s1.to(device)[:,64*ext_id:64*(ext_id+1)]), extra_features.to(device))))
+                                    logits = model((((x_p.to(device, non_blocking=True)[:,:,:,64*ext_id:64*(ext_id+1)], mask_p.to(device, non_blocking=True)[:,64*ext_id:64*(ext_id+1)]), extra_features.to(device, non_blocking=True)),
+                                                    ((x_s1.to(device, non_blocking=True)[:,:,:,64*ext_id:64*(ext_id+1)], mask_s1.to(device, non_blocking=True)[:,64*ext_id:64*(ext_id+1)]), extra_features.to(device, non_blocking=True))))
                                 else:
-                                    logits = model(((x_p.to(device)[:,:,:,64*ext_id:64*(ext_id+1)], mask_p.to(device)[:,64*ext_id:64*(ext_id+1)]), (x_s1.to(device)[:,:,:,64*ext_id:64*(ext_id+1)], mask_s1.to(device)[:,64*ext_id:64*(ext_id+1)])))
+                                    logits = model(((x_p.to(device, non_blocking=True)[:,:,:,64*ext_id:64*(ext_id+1)], mask_p.to(device, non_blocking=True)[:,64*ext_id:64*(ext_id+1)]), (x_s1.to(device, non_blocking=True)[:,:,:,64*ext_id:64*(ext_id+1)], mask_s1.to(device, non_blocking=True)[:,64*ext_id:64*(ext_id+1)])))
                             
                             # not implemented average of samples
                             elif len(args.input_data)==3:
@@ -314,32 +344,31 @@ def save_predictions(target_dir, model, data_loader, device, label_ids, label_na
                                 (x_s1, mask_s1, _, _), _ = sample_s1
                                 (x_s2, mask_s2, _, _), _ = sample_s2
                                 if args.include_extras: 
-                                    logits = model((((x_p.to(device), mask_p.to(device)), extra_features.to(device)), (x_s1.to(device), mask_s1.to(device)), (x_s2.to(device), mask_s2.to(device)))) 
+                                    logits = model((((x_p.to(device, non_blocking=True), mask_p.to(device, non_blocking=True)), extra_features.to(device, non_blocking=True)), (x_s1.to(device, non_blocking=True), mask_s1.to(device, non_blocking=True)), (x_s2.to(device, non_blocking=True), mask_s2.to(device, non_blocking=True)))) 
                                 else:
-                                    logits = model(((x_p.to(device), mask_p.to(device)), (x_s1.to(device), mask_s1.to(device)), (x_s2.to(device), mask_s2.to(device))))           
-
-                            batch_s = x_p.size(0)
-                            for i in range(logits.size()[0]):
-                                logits_i = logits[i].view(1,-1)
-                                predicted_probabilities = softmax(logits_i).cpu().detach().numpy()[0]
-                                probs_array[idx*batch_s+i] += predicted_probabilities # idx*batch_s:(idx*batch_s)+batch_s
-
-                                if fold==(num_folds-1) and ext_id==(num_samples_per_crop-1):
-                                    probs_array_ids=probs_array[idx*batch_s+i]/((num_folds-not_found)*num_samples_per_crop)
-                                    fid_i = fid[i].view(1,-1)[0]
-                                    predicted_class = np.argmax(probs_array_ids)
-                                    output_list.append({'fid': fid_i.cpu().detach().numpy()[0],
-                                                'crop_id': label_ids[predicted_class],
-                                                'crop_name': label_names[predicted_class],
-                                                'crop_probs': np.array(probs_array_ids)})
+                                    logits = model(((x_p.to(device, non_blocking=True), mask_p.to(device, non_blocking=True)), (x_s1.to(device, non_blocking=True), mask_s1.to(device, non_blocking=True)), (x_s2.to(device, non_blocking=True), mask_s2.to(device, non_blocking=True))))           
+
+                            # accumulate the probabilities of the whole batch at once
+                            batch_s = logits.size(0)
+                            probs_array[offset:offset+batch_s] += softmax(logits.float()).cpu().numpy()
+
+                        fid_list.append(fid.view(-1).cpu().numpy())
+                        offset += batch_s
 
         else:
             print(f"INFO: no best model found for fold {fold_id}")
             not_found+=1
             
+    # average over folds and samples per crop and pick the most probable class
+    probs_array = probs_array[:offset]/((num_folds-not_found)*num_samples_per_crop)
+    predicted_class = np.argmax(probs_array, axis=1)
+
     #  save predictions into output json:
     output_name = os.path.join(args.target_dir, filename)
     print(f'Submission was saved to location: {(output_name)}')
-    output_frame = pd.DataFrame.from_dict(output_list)
+    output_frame = pd.DataFrame({'fid': np.concatenate(fid_list),
+                                 'crop_id': np.asarray(label_ids)[predicted_class],
+                                 'crop_name': np.asarray(label_names)[predicted_class],
+                                 'crop_probs': list(probs_array)})
     output_frame.to_json(output_name)
 
@@ -20,29 +20,62 @@ from models.stclassifier import PseLTae, PseTae
 from models.stclassifier_combined import PseLTaeCombinedPlanetS1S2, PseLTaeCombinedPlanetS1
 
 import torch
+import torch.multiprocessing
 from torch import nn
 import torch.nn.functional as F
 from torch.utils.data import Dataset, DataLoader, random_split
 from torch.optim import Adam
 from torch.nn import CrossEntropyLoss
-from sklearn.model_selection import KFold
-from datasets import CombinedDataset, AddGaussianNoise
+from sklearn.model_selection import StratifiedKFold
+from datasets import CombinedDataset, AddGaussianNoise, CUDAPrefetcher
 
 import numpy as np
 import geopandas as gpd
 import pandas as pd
-import copy
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-def reset_weights(m):
+# background writer for checkpoints so that training does not wait for the disk
+ckpt_executor = ThreadPoolExecutor(max_workers=1)
+
+def state_dict_to_cpu(state):
+    '''
+    Snapshot of a (nested) model or optimizer state dict
+    with all tensors copied to the CPU
+    '''
+    if isinstance(state, torch.Tensor):
+        return state.detach().cpu().clone()
+    if isinstance(state, dict):
+        return {key: state_dict_to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_dict_to_cpu(value) for value in state)
+    return state
+
+def samples_of_fields(all_field_ids, field_ids):
+    '''
+    Indices of all samples that belong to the (sorted) field_ids,
+    grouped by field in ascending field id order
+    '''
+    ix = np.flatnonzero(np.isin(all_field_ids, field_ids))
+    return ix[np.argsort(all_field_ids[ix], kind='stable')]
+
+def build_model(args, device):
     '''
-    Try resetting model weights to avoid
-    weight leakage.
+    Instantiate the model for the input data sources and move it to the device
+    :param args: command line arguments
+    :param device: torch device
     '''
-    for layer in m.children():
-        if hasattr(layer, 'reset_parameters'):
-            print(f'Reset trainable parameters of layer = {layer}')
-            layer.reset_parameters()
+    if len(args.input_data)==1: model = PseLTae(**args.model_config)  #PseTae(**args.model_config) # 
+    elif len(args.input_data)==2: model = PseLTaeCombinedPlanetS1(**args.model_config)
+    else: model = PseLTaeCombinedPlanetS1S2(**args.model_config)
+    model = model.to(device)
+    if args.compile:
+        # compiles the forward in place, the state dict keys stay the same
+        if hasattr(torch, 'compile') and hasattr(model, 'compile'):
+            model.compile(mode='max-autotune')
+        else:
+            print('WARNING: torch.compile not available in this torch version, running eagerly')
+    return model
 
 def main(args):
     
@@ -50,6 +83,9 @@ def main(args):
     np.random.seed(1)
     if not args.augmentation: torch.manual_seed(1)
     torch.cuda.manual_seed_all(1)
+    # input shapes are fixed (drop_last, fixed sequence length): let cuDNN pick the fastest kernels once
+    # non-deterministic algorithms may be chosen, disable for exactly reproducible runs
+    torch.backends.cudnn.benchmark = bool(args.cudnn_benchmark)
     # construct the dataset
     test_dataset = CombinedDataset(args) 
 
@@ -65,14 +101,28 @@ def main(args):
     # set device to GPU, if available
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f'\nDevice {device}')
+    # float16 autocast and loss scaling are CUDA only
+    args.amp = int(args.amp and torch.cuda.is_available())
+    # page-locked batches let the non-blocking copies to the GPU run asynchronously
+    # pin_memory together with persistent workers and a large prefetch_factor is known to leak
+    # pinned host memory in some torch versions (cudaHostAlloc without cudaFreeHost), which is why
+    # the prefetch_factor defaults to 2 and pinning can be switched off with --pin-memory 0
+    pin_memory = bool(args.pin_memory) and torch.cuda.is_available()
+    # let each worker read ahead args.prefetch_factor batches (only valid with worker processes)
+    prefetch_kwargs = dict(prefetch_factor=args.prefetch_factor) if args.num_workers > 0 else dict()
+    # keep the workers of the fold loaders alive across epochs
+    worker_kwargs = dict(persistent_workers=True, **prefetch_kwargs) if args.num_workers > 0 else dict()
 
     if args.nni:
         k_best_metrics = [] # gather the k best metrics and then report the mean
 
     if args.split=='train':
 
+        # the per-fold statistics index into the label array held by the dataset
+        all_labels = test_dataset.labels
+
         print('Labels in train and valid / (test)')
-        (unique, counts) = np.unique(test_dataset[:][0][1], return_counts=True)
+        (unique, counts) = np.unique(all_labels, return_counts=True)
         frequencies = np.asarray((unique, counts)).T
         print(frequencies)
         
@@ -95,8 +145,10 @@ def main(args):
         else:
             alpha = None
         criterion = FocalLoss(gamma=args.gamma, alpha=alpha) # gamma can be set as a hyperparamter
-        unique_field_ids = np.unique(test_dataset.datasets[0].fid)
-        all_field_ids = test_dataset.datasets[0].fid
+        all_field_ids = test_dataset.field_ids
+        unique_field_ids, first_sample_ids = np.unique(all_field_ids, return_index=True)
+        # crop type of each field, all samples of a field share its label
+        field_labels = all_labels[first_sample_ids]
 
         print('Identified unique field IDs: ', len(unique_field_ids))
         
@@ -111,9 +163,29 @@ def main(args):
         else: gaussian_noise_aug = None
             
         
-        kfold = KFold(n_splits=args.k_folds, shuffle=True, random_state=7) #StratifiedKFold(n_splits=args.k_folds, shuffle=True) 
+        # split the fields, not the samples, stratified by crop type so that
+        # every validation fold contains all classes
+        kfold = StratifiedKFold(n_splits=args.k_folds, shuffle=True, random_state=7)
+
+        # sample indices of all folds, computed once before training
+        folds = [(samples_of_fields(all_field_ids, unique_field_ids[train_field_ids]),
+                  samples_of_fields(all_field_ids, unique_field_ids[val_field_ids]))
+                 for train_field_ids, val_field_ids in kfold.split(unique_field_ids, field_labels)]
+
+        # instantiate the model and optimizer once for all folds
+        model = build_model(args, device)
+
+        # Initialize model optimizer and loss criterion:
+        optimizer = Adam(model.parameters(), lr=args.learning_rate, weight_decay=args.weight_decay) #, eps=10e-4)
+
+        # snapshots of the initial states, restored for each fold to avoid weight leakage
+        init_model_state = state_dict_to_cpu(model.state_dict())
+        init_optimizer_state = state_dict_to_cpu(optimizer.state_dict())
 
-        for fold, (train_field_ids, val_field_ids) in enumerate(kfold.split(unique_field_ids)):
+        # pending background checkpoint write, its result is checked to surface write errors
+        ckpt_future = None
+
+        for fold, (train_ids, val_ids) in enumerate(folds):
 
             print('----------------------------------------------')
             print(f'STARTING FOLD {fold}')
@@ -124,19 +196,12 @@ def main(args):
             best_accuracy = 0
             best_epoch = 0
             patience_count = 0
-            all_train_losses = []
-            all_valid_losses = []
+            # loss history, filled up to n_epochs (early stopping)
+            all_train_losses = np.empty(args.max_epochs)
+            all_valid_losses = np.empty(args.max_epochs)
+            n_epochs = 0
             log_scores= []
 
-            train_ids = []
-            val_ids   = []
-
-            for ufi in unique_field_ids[train_field_ids]:
-                train_ids.extend(np.where(all_field_ids == ufi)[0])
-
-            for ufi in unique_field_ids[val_field_ids]:
-                val_ids.extend(np.where(all_field_ids == ufi)[0])
-
             # shuffle the sequences in place
             np.random.shuffle(train_ids)
 
@@ -146,30 +211,30 @@ def main(args):
             train_subsampler = torch.utils.data.SubsetRandomSampler(train_ids)
             val_subsampler = torch.utils.data.SubsetRandomSampler(val_ids)
 
-            train_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.num_workers, 
-                                      timeout=0, drop_last=True, sampler=train_subsampler)
-            valid_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.num_workers, 
-                                      timeout=0, drop_last=True, sampler=val_subsampler)
+            train_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.num_workers, pin_memory=pin_memory, 
+                                      timeout=0, drop_last=True, sampler=train_subsampler, **worker_kwargs)
+            valid_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.num_workers, pin_memory=pin_memory, 
+                                      timeout=0, drop_last=True, sampler=val_subsampler, **worker_kwargs)
+            if torch.cuda.is_available():
+                # overlap the copy of the next batch to the GPU with the current step
+                train_loader = CUDAPrefetcher(train_loader, device)
+                valid_loader = CUDAPrefetcher(valid_loader, device)
 
             print('Size of train loader: ', len(train_loader), 'and val loader: ', len(valid_loader))
-            (unique, counts) = np.unique(test_dataset[train_ids][0][1], return_counts=True)
+            (unique, counts) = np.unique(all_labels[train_ids], return_counts=True)
 
 
             frequencies = np.asarray((unique, counts)).T
             print('Labels in train: ',frequencies)
-            (unique, counts) = np.unique(test_dataset[val_ids][0][1], return_counts=True)
+            (unique, counts) = np.unique(all_labels[val_ids], return_counts=True)
             frequencies = np.asarray((unique, counts)).T
             print('Labels in validation: ',frequencies)
 
-            # instantiate the model
-            if len(args.input_data)==1: model = PseLTae(**model_config) 
-            elif len(args.input_data)==2: model = PseLTaeCombinedPlanetS1(**model_config)
-            else: model = PseLTaeCombinedPlanetS1S2(**model_config)
-            if torch.cuda.is_available():
-                model = model.cuda()  
- 
-            # Initialize model optimizer and loss criterion:
-            optimizer = Adam(model.parameters(), lr=args.learning_rate, weight_decay=args.weight_decay) #, eps=10e-4)
+            # start every fold from the initial weights and a fresh optimizer state
+            model.load_state_dict(init_model_state)
+            optimizer.load_state_dict(init_optimizer_state)
+            # loss scaling for float16 mixed precision, disabled without args.amp
+            scaler = torch.cuda.amp.GradScaler(enabled=bool(args.amp))
 
             for epoch in range(args.max_epochs):
                 # train
@@ -177,9 +242,9 @@ def main(args):
                 start_time = time.time()
                 print(f'\nEpoch: {epoch}')
                 classes = len(label_ids)
-                train_loss = train_epoch(model, optimizer, train_loader, classes, criterion, args, device=device, gaussian_noise_aug=gaussian_noise_aug)
-                train_loss = train_loss.cpu().detach().numpy()[0]
-                all_train_losses.append(train_loss)
+                train_loss = train_epoch(model, optimizer, train_loader, classes, criterion, args, device=device, gaussian_noise_aug=gaussian_noise_aug, scaler=scaler)
+                train_loss = train_loss.mean().item() # mean over the steps, single sync with the GPU per epoch
+                all_train_losses[epoch] = train_loss
 
                 print(f'Training took {(time.time() - start_time) / 60:.2f} minutes, \
                         train_loss: {train_loss:.4}')
@@ -192,9 +257,10 @@ def main(args):
                                                                                 criterion,
                                                                                 args, 
                                                                                 device=device)
-                valid_loss = valid_loss.cpu().detach().numpy()[0]
+                valid_loss = valid_loss.mean().item() # mean over the steps, single sync with the GPU
                 assert not np.isnan(valid_loss)
-                all_valid_losses.append(valid_loss)
+                all_valid_losses[epoch] = valid_loss
+                n_epochs = epoch + 1
 
                 # calculate metrics
                 scores = metrics(y_true.cpu(), y_pred.cpu())
@@ -217,8 +283,8 @@ def main(args):
                     best_loss = valid_loss
                     best_accuracy = scores['accuracy']
                     best_epoch = epoch
-                    best_model = copy.deepcopy(model)
-                    best_optimizer = copy.deepcopy(optimizer)
+                    best_model_state = state_dict_to_cpu(model.state_dict())
+                    best_optimizer_state = state_dict_to_cpu(optimizer.state_dict())
                     best_preds = y_pred
                     patience_count = 0
                 else:
@@ -232,7 +298,13 @@ def main(args):
                 # save checkpoints
                 if epoch % args.checkpoint_epoch == 0 and epoch != 0:
                     save_model_path = os.path.join(args.target_dir, f'epoch_{epoch}_model.pt')
-                    torch.save(dict(model_state=model.state_dict(), optimizer_state=optimizer.state_dict(), epoch=epoch, log=log_scores), save_model_path)
+                    # cpu snapshot, the saver thread must not see the next epoch's updates
+                    # (the score log is only saved with the best model at the end of the fold)
+                    if ckpt_future is not None:
+                        ckpt_future.result() # re-raises if the previous write failed
+                    ckpt_future = ckpt_executor.submit(torch.save, dict(model_state=state_dict_to_cpu(model.state_dict()), 
+                                                                       optimizer_state=state_dict_to_cpu(optimizer.state_dict()), 
+                                                                       epoch=epoch), save_model_path)
 
             # nni
             if args.nni:
@@ -241,39 +313,32 @@ def main(args):
 
             # save best model
             save_model_path = os.path.join(args.target_dir, f'best_model_fold_{fold}.pt') 
-            torch.save(dict(model_state=best_model.state_dict(), optimizer_state=best_optimizer.state_dict(), epoch=best_epoch, log=log_scores), save_model_path)
+            # written synchronously, save_predictions reads it back right away
+            torch.save(dict(model_state=best_model_state, optimizer_state=best_optimizer_state, epoch=best_epoch, log=log_scores), save_model_path)
             print(f'saved best model to {save_model_path}')
 
             # save training and validation history
-            with open(os.path.join(args.target_dir, f'train_losses_fold_{fold}.txt'), 'w') as f:
-                for tl in all_train_losses:
-                    f.write(f'{tl:.4f}\n')
-            with open(os.path.join(args.target_dir, f'valid_losses_fold_{fold}.txt'), 'w') as f:
-                for vl in all_valid_losses:
-                    f.write(f'{vl:.4f}\n')
-
-                print(f"\nINFO: Saved training and validation history ") 
-                print(f"\nINFO: Epoch {epoch}: train_loss {train_loss:.2f}, valid_loss {valid_loss:.2f} ") 
-            model.apply(reset_weights)
+            np.savetxt(os.path.join(args.target_dir, f'train_losses_fold_{fold}.txt'), all_train_losses[:n_epochs], fmt='%.4f')
+            np.savetxt(os.path.join(args.target_dir, f'valid_losses_fold_{fold}.txt'), all_valid_losses[:n_epochs], fmt='%.4f')
+
+            print(f"\nINFO: Saved training and validation history ") 
+            print(f"\nINFO: Epoch {epoch}: train_loss {train_loss:.2f}, valid_loss {valid_loss:.2f} ") 
             
             if args.save_preds:
                 print(f'\nINFO: saving predictions from the {args.split} set')
                 save_predictions(args.target_dir, model, valid_loader, device, label_ids, label_names, args, len(val_subsampler), num_folds=1, fold_id=fold, filename=f'{args.split}_{fold}.json')
+
+        # wait for the last checkpoint write, re-raises if it failed
+        if ckpt_future is not None:
+            ckpt_future.result()
             
     else:
-        # instatiate the model
-        if len(args.input_data)==1: model = PseLTae(**model_config)  #PseTae(**model_config) # 
-        elif len(args.input_data)==2: model = PseLTaeCombinedPlanetS1(**model_config)
-        else: model = PseLTaeCombinedPlanetS1S2(**model_config)
-
-        if torch.cuda.is_available():
-            model = model.cuda()   
-                    
-        test_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.num_workers)
-    
-        # make predictions   
+        # make predictions, save_predictions loads the best model of each fold
         if args.save_preds:
-            test_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.num_workers)
+            model = build_model(args, device)
+            test_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.num_workers, pin_memory=pin_memory, **prefetch_kwargs)
+            if torch.cuda.is_available():
+                test_loader = CUDAPrefetcher(test_loader, device)
             print(f'\nINFO: saving predictions from the {args.split} set')
             if args.majority:
                 save_predictions(args.target_dir, model, test_loader, device, label_ids, label_names, args, len(test_dataset), num_folds=args.k_folds)
@@ -283,9 +348,9 @@ def main(args):
     # save reference
     if args.save_ref:
         if args.split == 'train':
-            test_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.num_workers)
+            test_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.num_workers, pin_memory=pin_memory, **prefetch_kwargs)
         else:
-            test_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.num_workers)
+            test_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.num_workers, pin_memory=pin_memory, **prefetch_kwargs)
         print(f'\nINFO: saving reference from the {args.split} set')
         save_reference(test_loader, device, label_ids, label_names, args)
 
@@ -473,6 +538,8 @@ if __name__ == '__main__':
     parser.add_argument('--input-dim', type=int, nargs="*", default=[4])
     parser.add_argument('--sequence-length', type=int, default=74)
     parser.add_argument('--num-workers', type=int, default=0, help='Timeout if > 0 for combined dataset')
+    parser.add_argument('--pin-memory', type=int, default=1, choices=[0,1], help='Page-locked batches for faster copies to the GPU')
+    parser.add_argument('--prefetch-factor', type=int, default=2, help='Batches loaded in advance by each worker (num-workers > 0)')
     parser.add_argument('--ndvi', type=int, default=0, choices=[0, 1])
     parser.add_argument('--nri', type=int, default=0, choices=[0, 1])
     parser.add_argument('--drop-channels', type=int, default=0, choices=[0, 1]) # if set then ndvi and/or nri also need to be set and input-dim set to 1
@@ -480,6 +547,9 @@ if __name__ == '__main__':
     parser.add_argument('--drop-channels-sentinel2', type=int, default=1, choices=[0, 1]) # like drop-channels, but only for sentinel2 -- default 1 ! --
     parser.add_argument('--fill-value', type=bool, default=0)
     parser.add_argument('--augmentation', type=int, default=0, choices=[0,1]) # add gaussian noise to samples
+    parser.add_argument('--cudnn-benchmark', type=int, default=1, choices=[0,1], help='cuDNN autotuning, disable for reproducibility')
+    parser.add_argument('--compile', type=int, default=0, choices=[0,1], help='Compile the model with torch.compile (torch >= 2.1)')
+    parser.add_argument('--amp', type=int, default=0, choices=[0,1], help='Mixed precision (float16) forward pass on the GPU')
     # for pseltae model
     parser.add_argument('--include-extras', type=int, default=0, choices=[0, 1])
     parser.add_argument('--learning-rate', type=float, default=1e-3, help='In Adam optimizer')
@@ -526,8 +596,14 @@ if __name__ == '__main__':
         print(f'{key:20s}: {value}')
     print('end args keys / value\n')
     
-    model_config = get_pselatae_model_config(args, verbose=True)
-    args.model_config = model_config
+    args.model_config = get_pselatae_model_config(args, verbose=True)
+
+    # keep the default file_descriptor strategy unless requested: file_system leaks shared memory
+    if os.environ.get('PYTORCH_SHARING') == 'file_system':
+        torch.multiprocessing.set_sharing_strategy('file_system')
 
     main(args)
 
+    # wait for pending checkpoint writes
+    ckpt_executor.shutdown(wait=True)
+